@@ -1,60 +1,133 @@
+import aiohttp
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import csv
 import cv2
 import discord
 from discord.ext import commands
-from io import BytesIO
-import Levenshtein
+import json
+import multiprocessing
 import numpy
 import os
+
+# Numba is optional: when it is available remove_color runs as a compiled single-pass kernel
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 import pytesseract
-import requests
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
+import string
 import sys
+import unicodedata
+
+# Tesseract's OpenMP parallelism scales negatively on single pages, so pin it to one thread
+os.environ.setdefault( 'OMP_THREAD_LIMIT', '1' )
+
+# tesserocr is optional: it keeps a Tesseract instance alive across requests instead of
+# spawning a fresh process (and reloading the LSTM model) for every call
+try:
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
 
 A4_HEIGHT_PIXELS = 2970
 A4_WIDTH_PIXELS = 2100
 
 character_mapping = {}
+character_choices = []
+normalized_character_mapping = {}
+character_bigrams = {}
+minimum_choice_length = 0
+maximum_choice_length = 0
+
+_punctuation_table = str.maketrans( '', '', string.punctuation )
+
+def _bigram_set( text ):
+    """Return the set of adjacent character pairs in a string"""
+    return frozenset( text[ i : i + 2 ] for i in range( len( text ) - 1 ) )
+
+def normalize_character_name( name ):
+    """Normalize a name for fuzzy comparison: fold unicode, lowercase, drop punctuation and extra whitespace"""
+    name = unicodedata.normalize( 'NFKD', name ).lower().translate( _punctuation_table )
+    return ' '.join( name.split() )
 
 def load_character_mapping():
     """Load the character data from the file on disk"""
 
+    global character_choices, normalized_character_mapping, character_bigrams
+    global minimum_choice_length, maximum_choice_length
+
     character_tsv_file = 'characters.tsv'
-    
-    with open( character_tsv_file, 'r' ) as file:
-        for line in file:
-            columns = line.strip().split( '\t' )
-            if len(columns) == 2:
-                key = columns[ 0 ]
-                value = columns[ 1 ]
-                character_mapping[ key ] = value
 
+    with open( character_tsv_file, 'r', newline = '' ) as file:
+        rows = csv.reader( file, delimiter = '\t' )
+        character_mapping.update( { row[ 0 ]: row[ 1 ] for row in rows if len( row ) == 2 } )
+
+    # Fuzzy lookups compare normalized forms, so case, punctuation, and spacing noise in the
+    # scanned text does not count towards the edit distance
+    normalized_character_mapping = { normalize_character_name( key ): value for key, value in character_mapping.items() }
+
+    # Cache the keys as a list so fuzzy lookups can scan them without re-materializing the view
+    character_choices = list( normalized_character_mapping.keys() )
+
+    # Precompute bigram sets so a cheap overlap check can reject most candidates before the
+    # Levenshtein scan even starts
+    character_bigrams = { key: _bigram_set( key ) for key in character_choices }
+
+    # Record the length range of the keys so impossibly short or long scans can bail out early
+    minimum_choice_length = min( len( key ) for key in character_choices )
+    maximum_choice_length = max( len( key ) for key in character_choices )
+
+
+if njit is not None:
+    @njit( parallel = True, fastmath = True, cache = True )
+    def _remove_color_kernel( image, threshold, out ):
+        """Write the grayscale value of each grey pixel and white for each colored pixel"""
+        for i in prange( image.shape[ 0 ] ):
+            for j in range( image.shape[ 1 ] ):
+                # Cast to signed explicitly: numba keeps plain int() of a uint8 unsigned,
+                # so the channel differences would wrap instead of going negative
+                b = numpy.int32( image[ i, j, 0 ] )
+                g = numpy.int32( image[ i, j, 1 ] )
+                r = numpy.int32( image[ i, j, 2 ] )
+                if abs( r - g ) > threshold or abs( r - b ) > threshold or abs( g - b ) > threshold:
+                    out[ i, j ] = 255
+                else:
+                    out[ i, j ] = ( r * 77 + g * 150 + b * 29 + 128 ) >> 8
+
+    # Warm the JIT at import time so the first real image does not pay the compile cost
+    _remove_color_kernel( numpy.zeros( ( 1, 1, 3 ), numpy.uint8 ), 30, numpy.empty( ( 1, 1 ), numpy.uint8 ) )
 
 def remove_color( image, threshold = 30 ):
-    """Replace any colored pixels with white"""
-    
-    # Calculate the absolute difference between the RGB channels
-    diff_rg = numpy.abs( image[ :, :, 0 ] - image[ :, :, 1 ] )
-    diff_rb = numpy.abs( image[ :, :, 0 ] - image[ :, :, 2 ] )
-    diff_gb = numpy.abs( image[ :, :, 1 ] - image[ :, :, 2 ] )
-    
-    # Create a mask for pixels that are not close to being grey
-    non_grey_mask = ( diff_rg > threshold ) | ( diff_rb > threshold ) | ( diff_gb > threshold )
-    
-    # Conert the image to grayscale, setting colored pixels to white using the mask
+    """Replace any colored pixels in a BGR image with white"""
+
+    # A single compiled pass touches each pixel once: one 3-byte load and one 1-byte store
+    if njit is not None:
+        gray_image = numpy.empty( image.shape[ :2 ], numpy.uint8 )
+        _remove_color_kernel( image, threshold, gray_image )
+        return gray_image
+
+    # Calculate the largest absolute difference between the RGB channels, staying in uint8
+    diff_rg = cv2.absdiff( image[ :, :, 0 ], image[ :, :, 1 ] )
+    diff_rb = cv2.absdiff( image[ :, :, 0 ], image[ :, :, 2 ] )
+    diff_gb = cv2.absdiff( image[ :, :, 1 ], image[ :, :, 2 ] )
+    max_diff = cv2.max( cv2.max( diff_rg, diff_rb ), diff_gb )
+
+    # Create a mask for pixels that are not close to being grey (255 where colored, 0 elsewhere)
+    non_grey_mask = cv2.inRange( max_diff, threshold + 1, 255 )
+
+    # Convert the image to grayscale, setting colored pixels to white by applying the mask in place
     gray_image = cv2.cvtColor( image, cv2.COLOR_BGR2GRAY )
-    gray_image[ non_grey_mask ] = 255
+    cv2.bitwise_or( gray_image, non_grey_mask, dst = gray_image )
     return gray_image
 
-def normalize_height( image, height ):
-    """Scale an image to a particular height, maintaining the original aspect ratio"""
-    ( h, w ) = image.shape[ :2 ]
-    aspect_ratio = w / h
-    ( h_norm, w_norm ) = ( height, int( height * aspect_ratio ) )
-    return cv2.resize( image, ( w_norm, h_norm ) )
-
-def crop_to_character_names( script_image ):
+def crop_to_character_names( script_image, scale ):
     """Given an image of a full script, this will crop it to just the list of character names"""
-    
-    width = numpy.size( script_image, 1 )
+
+    width = int( numpy.size( script_image, 1 ) * scale )
 
     if width < 1500:
         raise RuntimeError( f"Image is narrower than expected. width = {width}." )
@@ -68,7 +141,9 @@ def crop_to_character_names( script_image ):
     x_min += left_margin_size
     x_max += left_margin_size
 
-    return script_image[ y_min:y_max, x_min:x_max ]
+    # Crop at the image's native resolution, then rescale just the crop to the canonical size
+    crop = script_image[ int( y_min / scale ):int( y_max / scale ), int( x_min / scale ):int( x_max / scale ) ]
+    return cv2.resize( crop, ( x_max - x_min, y_max - y_min ) )
 
 def map_scanned_character_names_to_json_equivalent( names ):
     """Convert from printed character names to json names (e.g. "Scarlet Woman" -> "scarlet_woman")"""
@@ -82,11 +157,40 @@ def map_scanned_character_names_to_json_equivalent( names ):
             json_characters.append( json_character )
             continue
 
-        # Otherwise, compare the scanned text with all possible character names to see if there is one that is similar
-        dist = lambda x: Levenshtein.distance( name, x )
-        ( closest_match, distance ) = min( ( ( key, dist( key )) for key in character_mapping.keys()), key = lambda x: x[1] )
-        if distance <= 3:
-            json_characters.append( character_mapping.get( closest_match ) )
+        # Otherwise, try an exact match on the normalized form of the scanned text
+        normalized_name = normalize_character_name( name )
+        json_character = normalized_character_mapping.get( normalized_name )
+        if json_character != None:
+            json_characters.append( json_character )
+            continue
+
+        # The length difference is a lower bound on the edit distance, so a scan shorter or
+        # longer than every key by more than the cutoff cannot match anything
+        if len( normalized_name ) < minimum_choice_length - 3 or len( normalized_name ) > maximum_choice_length + 3:
+            raise RuntimeError( f"Failed to find a match for character name: {name}" )
+
+        # Keep only candidates whose bigrams overlap enough with the scanned text; if the scan
+        # is so mangled that nothing survives, fall back to comparing against every name
+        name_bigrams = _bigram_set( normalized_name )
+        candidates = character_choices
+        if name_bigrams:
+            survivors = [
+                key for key in character_choices
+                if len( name_bigrams & character_bigrams[ key ] ) / len( name_bigrams | character_bigrams[ key ] ) >= 0.3
+            ]
+            if survivors:
+                candidates = survivors
+
+        # Otherwise, find the character name closest to the scanned text, if any is close enough
+        match = process.extractOne( normalized_name, candidates, scorer = Levenshtein.distance, score_cutoff = 3 )
+
+        # The prefilter can occasionally discard a genuinely close name, so confirm a miss
+        # against the full list before giving up
+        if match is None and candidates is not character_choices:
+            match = process.extractOne( normalized_name, character_choices, scorer = Levenshtein.distance, score_cutoff = 3 )
+
+        if match is not None:
+            json_characters.append( normalized_character_mapping.get( match[ 0 ] ) )
             continue
 
         # If not, we have failed
@@ -94,51 +198,101 @@ def map_scanned_character_names_to_json_equivalent( names ):
 
     return json_characters
 
-def extract_character_names( script_image ):
-    """Given a processed script image, return a list of characters"""
-
-    character_names_image = crop_to_character_names( script_image )
+# Pool of worker processes for the CPU-bound OCR pipeline; when it is None the work falls
+# back to the event loop's default executor
+_ocr_pool = None
+
+_tesseract_apis = {}
+
+def ocr_image_to_string( image, psm, assume_binary = False ):
+    """Run Tesseract on an image, reusing a persistent API instance when tesserocr is available"""
+
+    if tesserocr is not None:
+        api = _tesseract_apis.get( psm )
+        if api is None:
+            api = tesserocr.PyTessBaseAPI( psm = psm )
+            _tesseract_apis[ psm ] = api
+        if assume_binary:
+            api.SetVariable( "thresholding_method", "0" )
+        api.SetImage( Image.fromarray( image ) )
+        return api.GetUTF8Text()
+
+    config = f"--psm {psm}"
+    if assume_binary:
+        config += " -c thresholding_method=0"
+    return pytesseract.image_to_string( image, config = config, timeout = 3 )
+
+def segment_text_lines( gray_image, padding = 2, minimum_height = 4 ):
+    """Find the row extents of each text line in a grayscale image using an ink projection"""
+
+    # Sum the inverted rows: blank rows sum to zero while rows crossing glyphs do not. Requiring
+    # at least one fully dark pixel's worth of ink per row filters out isolated specks
+    row_sums = cv2.reduce( 255 - gray_image, 1, cv2.REDUCE_SUM, dtype = cv2.CV_32S ).ravel()
+    has_ink = row_sums > 255
+
+    # Find the rows where runs of ink start and stop
+    edges = numpy.diff( has_ink.astype( numpy.int8 ) )
+    starts = list( numpy.flatnonzero( edges == 1 ) + 1 )
+    ends = list( numpy.flatnonzero( edges == -1 ) + 1 )
+    if len( has_ink ) > 0 and has_ink[ 0 ]:
+        starts.insert( 0, 0 )
+    if len( has_ink ) > 0 and has_ink[ -1 ]:
+        ends.append( len( has_ink ) )
+
+    return [
+        ( max( start - padding, 0 ), min( end + padding, len( has_ink ) ) )
+        for ( start, end ) in zip( starts, ends )
+        if end - start >= minimum_height
+    ]
+
+def extract_character_names( script_image, scale ):
+    """Given a script image and its scale relative to A4 size, return a list of characters"""
+
+    character_names_image = crop_to_character_names( script_image, scale )
 
     # We remove any colored parts to erase Jinx symbols as these can be detected as text.
     character_names_image = remove_color( character_names_image )
 
-    # By default OpenCV stores images in BGR format and since pytesseract assumes RGB format,
-    # we need to convert from BGR to RGB format/mode:
-    character_names_image = cv2.cvtColor( character_names_image, cv2.COLOR_BGR2RGB )
+    # Tesseract's LSTM is trained around a 30-40 px x-height and the A4-normalized crop is about
+    # double that, so halving the crop cuts OCR time roughly 4x without losing accuracy
+    character_names_image = cv2.resize( character_names_image, None, fx = 0.5, fy = 0.5, interpolation = cv2.INTER_AREA )
 
-    character_names_raw = ""
+    # Binarize up front so Tesseract can skip its own thresholding pass; the Gaussian window
+    # also evens out uneven lighting on photographed scripts and sharpens the line projection
+    character_names_image = cv2.adaptiveThreshold(
+        character_names_image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 21, 10,
+    )
+
+    character_names = []
 
     try:
-        character_names_raw = pytesseract.image_to_string(
-            character_names_image,
-            config = "--psm 4",
-            timeout = 3,
-        )
+        # Recognize each detected line on its own with PSM 7 (treat the image as a single text
+        # line), which skips the layout analysis a tall column would need
+        for ( y_start, y_end ) in segment_text_lines( character_names_image ):
+            line_text = ocr_image_to_string( character_names_image[ y_start:y_end, : ], psm = 7, assume_binary = True ).strip()
+            if line_text != '':
+                character_names.append( line_text )
     except RuntimeError as timeout_error:
         raise RuntimeError( "Image processing took too long when scanning character names" ) from timeout_error
 
-    character_names = character_names_raw.strip().split( "\n" )
-
-    # Remove any empty strings from the list
-    character_names = [ line for line in character_names if line.strip() != '' ]
-
     return map_scanned_character_names_to_json_equivalent( character_names )
 
-def extract_script_meta_data( script_image ):
-    """Given an image of a script, extract the name of the script and the author name"""
+def extract_script_meta_data( script_image, scale ):
+    """Given a grayscale image of a script, extract the name of the script and the author name"""
     script_name = ""
     author = ""
 
-    scaled_image_width = numpy.size( script_image, 1 )
-    title_image = script_image[ 50:100, 0:scaled_image_width ]
-    title_image = cv2.cvtColor( title_image, cv2.COLOR_BGR2RGB )
+    # Crop the title band at native resolution, then rescale just the band to its canonical size
+    scaled_image_width = int( numpy.size( script_image, 1 ) * scale )
+    title_image = script_image[ int( 50 / scale ):int( 100 / scale ), : ]
+    title_image = cv2.resize( title_image, ( scaled_image_width, 50 ) )
+
+    # Halve the title band as well; Tesseract gains nothing from the A4-sized resolution
+    title_image = cv2.resize( title_image, None, fx = 0.5, fy = 0.5, interpolation = cv2.INTER_AREA )
 
     try:
-        scanned_title_raw = pytesseract.image_to_string(
-            title_image,
-            #config = "--psm 7",
-            timeout = 3,
-        )
+        # PSM 3 is fully automatic page segmentation, the Tesseract default
+        scanned_title_raw = ocr_image_to_string( title_image, psm = 3 )
     except RuntimeError as timeout_error:
         raise RuntimeError( "Image processing took too long when scanning script metadata" ) from timeout_error
 
@@ -153,29 +307,44 @@ def extract_script_meta_data( script_image ):
 
 def combine_to_json_string( characters, script_name, author ):
     """Given all the script data, convert it into the standard JSON format"""
-    
-    json = f'[{{"id":"_meta","author":"{author}","name":"{script_name}"}}'
-    for name in characters:
-        json += f',"{name}"'
-    json +=']'
-
-    # Remove and line breaks or carriage returns
-    json = json.replace( "\n", "" ).replace( "\r", "" )
-
-    return json
-
-def script_image_to_json( input_image ):
-    """Given an image of a script, convert it into the standard JSON format"""
-    processed_script_image = normalize_height( input_image, A4_HEIGHT_PIXELS )
-    character_names = extract_character_names( processed_script_image )
-    ( script_name, author ) = extract_script_meta_data( processed_script_image )
-    json = combine_to_json_string( character_names, script_name, author )
-    return ( script_name, author, json )
-
-def bytesio_to_cv2_image( bytesio ):
-    image_bytes = bytesio.read()
-    np_array = numpy.frombuffer( image_bytes, numpy.uint8 )
-    return cv2.imdecode( np_array, cv2.IMREAD_COLOR )
+
+    # Strip line breaks at the source; json.dumps takes care of escaping everything else
+    meta = {
+        "id": "_meta",
+        "author": author.replace( "\n", "" ).replace( "\r", "" ),
+        "name": script_name.replace( "\n", "" ).replace( "\r", "" ),
+    }
+    return json.dumps( [ meta ] + characters, separators = ( ',', ':' ) )
+
+def script_image_to_json( image_buffer ):
+    """Given an encoded image of a script, convert it into the standard JSON format"""
+
+    # The name column needs color so remove_color can erase Jinx symbols, but the title band is
+    # plain dark-on-light text, so it can be decoded as grayscale at half size directly inside
+    # the image codec. Each decode's scale factor is computed relative to A4 size so the
+    # extractors can crop at native resolution and rescale only the regions they actually read
+    color_image = cv2.imdecode( image_buffer, cv2.IMREAD_COLOR )
+    gray_image = cv2.imdecode( image_buffer, cv2.IMREAD_REDUCED_GRAYSCALE_2 )
+
+    character_names = extract_character_names( color_image, A4_HEIGHT_PIXELS / numpy.size( color_image, 0 ) )
+    ( script_name, author ) = extract_script_meta_data( gray_image, A4_HEIGHT_PIXELS / numpy.size( gray_image, 0 ) )
+    json_string = combine_to_json_string( character_names, script_name, author )
+    return ( script_name, author, json_string )
+
+# Shared HTTP session, created lazily inside the event loop so repeat downloads reuse the
+# pooled connections and TLS session instead of re-handshaking with the CDN every time
+_http_session = None
+
+async def download_image_buffer( url ):
+    """Download an image without blocking the event loop, returning its encoded bytes"""
+
+    global _http_session
+    if _http_session is None:
+        _http_session = aiohttp.ClientSession()
+
+    async with _http_session.get( url ) as response:
+        image_bytes = await response.read()
+    return numpy.frombuffer( image_bytes, numpy.uint8 )
 
 def get_referenced_image( message ):
     """Given a Discord message context, return the first image attached to it."""
@@ -209,21 +378,23 @@ async def process_json_request( ctx ):
         return
 
     try:
-        response = requests.get( attached_image.url )
-        image = bytesio_to_cv2_image( BytesIO( response.content ) )
+        image_buffer = await download_image_buffer( attached_image.url )
     except Exception:
         await ctx.reply( "Something went wrong." )
         return
 
     try:
-        ( script_name, author, json ) = script_image_to_json( image )
+        # Run the CPU-bound OCR pipeline off the event loop so the bot stays responsive; the
+        # encoded buffer is also far cheaper to hand to a worker process than a decoded image
+        loop = asyncio.get_running_loop()
+        ( script_name, author, json_string ) = await loop.run_in_executor( _ocr_pool, script_image_to_json, image_buffer )
         reply_body = ""
         if len( script_name ) > 0:
             if len( author ) > 0:
                 reply_body = f"{script_name} by {author}\n"
             else:
                 reply_body = f"{script_name}\n"
-        reply_body += f"```json\n{ json }\n```"
+        reply_body += f"```json\n{ json_string }\n```"
         await ctx.reply( reply_body )
     except Exception:
         await ctx.reply( "Something went wrong." )
@@ -237,13 +408,24 @@ if __name__ == "__main__":
         print( "Error loading character data" )
         sys.exit(1)
 
+    # Each worker process loads its own character data and keeps its own persistent Tesseract
+    # API, so concurrent requests can be scanned in parallel across cores. Workers must be
+    # spawned rather than forked: numba's threading layer is not fork-safe once the JIT
+    # warm-up has run a parallel region
+    _ocr_pool = ProcessPoolExecutor(
+        max_workers = os.cpu_count(),
+        mp_context = multiprocessing.get_context( 'spawn' ),
+        initializer = load_character_mapping,
+    )
+
     intents = discord.Intents.default()
     intents.messages = True
     intents.message_content = True
     bot = commands.Bot( command_prefix='!', intents = intents )
 
-    @bot.command()
-    async def json( ctx ):
+    # The handler cannot itself be called "json" or it would shadow the json module
+    @bot.command( name = "json" )
+    async def json_command( ctx ):
         await process_json_request( ctx )
 
     bot.run( os.environ[ 'JSON_BOT_TOKEN' ] )